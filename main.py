@@ -1,180 +1,559 @@
 import geopandas as gpd
-from shapely import wkt
+import shapely
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import NearestNeighbors
-from shapely.geometry import LineString
+from scipy.spatial import cKDTree
 from timeit import default_timer as timer
-from math import atan2, degrees
 import argparse
-
-pd.options.mode.chained_assignment = None  # default='warn'
+import math
+
+try:
+    from numba import config, njit, prange, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        # Used bare as @njit, the function itself is the only argument.
+        if len(args) == 1 and not kwargs and callable(args[0]):
+            return args[0]
+
+        def decorator(func):
+            return func
+        return decorator
+
+try:
+    import pyogrio
+    IO_ENGINE = 'pyogrio'
+except ImportError:
+    IO_ENGINE = 'fiona'
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    ARROW_AVAILABLE = True
+except ImportError:
+    ARROW_AVAILABLE = False
+USE_ARROW = ARROW_AVAILABLE and IO_ENGINE == 'pyogrio'
+
+# Points closer than this amount of decimals are the same point, 7 decimals is about 1 cm in WGS84.
+COORDINATE_DECIMALS = 7
+POINT_DTYPE = np.dtype([('x', '<f8'), ('y', '<f8')])
+
+# The KD-tree is rebuilt once less than this fraction of its points is still active.
+TREE_REBUILD_FRACTION = 0.5
 
 
 def read_shp(path):
     """Reads a .shp file to a GeoPandas Data Frame
 
+    The file is read with pyogrio (through Arrow when pyarrow is installed),
+    or with fiona when pyogrio is not available.
+
     Arguments:
         path {String} -- A string containing the path to the .shp file.
 
     Returns:
         [GeoPandas Data Frame] -- A GeoPandas Data Frame containing the data read from the .shp file.
     """
-    df = gpd.read_file(path)
+    if IO_ENGINE == 'pyogrio':
+        df = pyogrio.read_dataframe(path, use_arrow=USE_ARROW)
+    else:
+        df = gpd.read_file(path, engine=IO_ENGINE)
     df.set_index('id', inplace=True)
     df.sort_index(inplace=True)
     return df
 
 
-def get_begin(points):
-    return points[0].wkt
+def get_coordinate_offsets(geometry):
+    """Gets the coordinates of all lines in geometry as one array.
+
+    Arguments:
+        geometry {GeoPandas GeometryArray} -- The LineStrings to get the coordinates of.
+
+    Returns:
+        [Tuple] -- A tuple of the (N, 2) coordinate array, and the offsets of the first
+        coordinate and one past the last coordinate of every line, in this order.
+
+    Raises:
+        ValueError -- When a geometry is missing, empty or not a LineString.
+    """
+    if len(geometry) == 0:
+        return np.empty((0, 2)), np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    missing = shapely.is_missing(geometry) | shapely.is_empty(geometry)
+    if np.any(missing):
+        raise ValueError(f"Missing or empty geometries at positions {np.flatnonzero(missing)[:10].tolist()}.")
+    not_a_line = shapely.get_type_id(geometry) != shapely.GeometryType.LINESTRING
+    if np.any(not_a_line):
+        raise ValueError(f"Only LineString geometries are supported, found other geometries at positions "
+                         f"{np.flatnonzero(not_a_line)[:10].tolist()}.")
+    _, coords, (offsets,) = shapely.to_ragged_array(geometry, include_z=False)
+    return coords, offsets[:-1], offsets[1:]
+
+
+def get_line_ends(geometry):
+    """Gets the coordinates at both ends of every line in geometry.
+
+    Arguments:
+        geometry {GeoPandas GeometryArray} -- The lines to get the coordinates of.
 
+    Returns:
+        [NumPy array] -- An (N, 4, 2) array containing the first, second, second to last
+        and last coordinate of every line, in this order.
+    """
+    coords, start_offsets, end_offsets = get_coordinate_offsets(geometry)
+    return np.stack([coords[start_offsets], coords[start_offsets + 1],
+                     coords[end_offsets - 2], coords[end_offsets - 1]], axis=1)
 
-def get_end(points):
-    return points[1].wkt
 
+def get_segments(geometry):
+    """Gets the first and the last segment of every line in geometry.
 
-def get_lines(df):
+    Arguments:
+        geometry {GeoPandas GeometryArray} -- The lines to get the segments of.
+
+    Returns:
+        [Tuple] -- A tuple of two (N, 2, 2) arrays containing the first two, and the
+        last two coordinates of every line, in this order.
+    """
+    line_ends = get_line_ends(geometry)
+    return line_ends[:, :2], line_ends[:, 2:]
+
+
+def get_point_keys(xy):
+    """Converts points to keys that can be compared and sorted as a whole.
+
+    Arguments:
+        xy {NumPy array} -- An (N, 2) array containing the coordinates of the points.
+
+    Returns:
+        [NumPy array] -- A structured array with the rounded x and y coordinate of every point.
+    """
+    keys = np.empty(len(xy), dtype=POINT_DTYPE)
+    keys['x'] = np.round(xy[:, 0], COORDINATE_DECIMALS)
+    keys['y'] = np.round(xy[:, 1], COORDINATE_DECIMALS)
+    return keys
+
+
+def match_points(end_keys, begin_keys):
+    """Matches the end points of the lines to the begin points of the lines.
+
+    The end points are sorted once, and both searches for the begin points
+    run on that sorted array. Equal end points form one run in the sorted
+    array, every begin point marks the run it falls in as matched.
+
+    Arguments:
+        end_keys {NumPy array} -- The end points, from get_point_keys().
+        begin_keys {NumPy array} -- The begin points, from get_point_keys().
+
+    Returns:
+        [Tuple] -- A tuple of boolean arrays telling which end points are the begin point of a line,
+        and which begin points are the end point of a line, in this order.
+    """
+    order = np.argsort(end_keys)
+    sorted_end_keys = end_keys[order]
+    left = np.searchsorted(sorted_end_keys, begin_keys, side='left')
+    right = np.searchsorted(sorted_end_keys, begin_keys, side='right')
+    begin_matched = right > left
+
+    cover = np.bincount(left, minlength=len(end_keys) + 1) - np.bincount(right, minlength=len(end_keys) + 1)
+    end_matched = np.empty(len(end_keys), dtype=bool)
+    end_matched[order] = np.cumsum(cover[:-1]) > 0
+    return end_matched, begin_matched
+
+
+def get_lines(df, line_ends=None, return_positions=False):
     """This function determines which lines do not have a follow up line, 
     and which lines do not have a lead line.
 
     It does this by comparing the exterior points of a line to the exterior
     points of all other lines. If the exterior point of line a cannot be found
     in the exterior points of any other line, we conclude that line a has no
-    lead/ follow-up line.
+    lead/ follow-up line. Points are compared after rounding their coordinates
+    to COORDINATE_DECIMALS decimals.
+
+    The coordinates of the begin and end points are stored in the
+    b_x, b_y, e_x and e_y columns of df.
 
 
     Arguments:
         df {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the line data.
+        line_ends {NumPy array} -- The optional coordinates of the lines in df, from get_line_ends().
+        return_positions {bool} -- Also return the positions in df of both sets of lines.
 
     Returns:
         [Tuple] -- A tuple of the lines without a follow-up line, and lines without 
-        a lead line, in this order.
+        a lead line, in this order. With return_positions their positions in df follow.
     """
-    df['b_point'] = df.geometry.boundary.apply(get_begin)
-    df['e_point'] = df.geometry.boundary.apply(get_end)
-    lines_no_end = df[~df.e_point.isin(df.b_point)]
-    lines_no_begin = df[~df.b_point.isin(df.e_point)]
+    if line_ends is None:
+        line_ends = get_line_ends(df.geometry.values)
+    begin_xy = line_ends[:, 0]
+    end_xy = line_ends[:, 3]
+
+    df['b_x'], df['b_y'] = begin_xy[:, 0], begin_xy[:, 1]
+    df['e_x'], df['e_y'] = end_xy[:, 0], end_xy[:, 1]
+
+    begin_points = get_point_keys(begin_xy)
+    end_points = get_point_keys(end_xy)
+    end_matched, begin_matched = match_points(end_points, begin_points)
+    lines_no_end = df[~end_matched].copy()
+    lines_no_begin = df[~begin_matched].copy()
+    if return_positions:
+        return lines_no_end, lines_no_begin, np.flatnonzero(~end_matched), np.flatnonzero(~begin_matched)
     return lines_no_end, lines_no_begin
 
 
-def AngleBtw2Points(point_a, point_b):
-    change_x = point_b[0] - point_a[0]
-    change_y = point_b[1] - point_a[1]
-    return degrees(atan2(change_y, change_x))
+def get_angles(points_a, points_b):
+    """Calculates the angle in radians of the lines from points_a to points_b.
+
+    Arguments:
+        points_a {NumPy array} -- An (N, 2) array, or a single point, containing the begin points.
+        points_b {NumPy array} -- An (N, 2) array, or a single point, containing the end points.
+
+    Returns:
+        [NumPy array] -- The angles of the lines, between -pi and pi.
+    """
+    change = np.asarray(points_b, dtype=float) - np.asarray(points_a, dtype=float)
+    return np.arctan2(change[..., 1], change[..., 0])
+
+
+@njit(cache=True)
+def get_angle_difference(angle_a, angle_b):
+    """Calculates the absolute difference between two angles in radians.
+
+    The difference wraps around, so angles just below pi and just above -pi are close.
+
+    Arguments:
+        angle_a {NumPy array} -- The first angles, or a single angle.
+        angle_b {NumPy array} -- The second angles, or a single angle.
+
+    Returns:
+        [NumPy array] -- The differences between the angles, between 0 and pi.
+    """
+    return np.abs((angle_a - angle_b + np.pi) % (2 * np.pi) - np.pi)
+
+
+def get_begin_points(lines):
+    return np.column_stack([lines.b_x.to_numpy(), lines.b_y.to_numpy()])
+
+
+def get_end_points(lines):
+    return np.column_stack([lines.e_x.to_numpy(), lines.e_y.to_numpy()])
+
+
+def build_end_point_tree(lines_no_end, active=None, end_points=None):
+    """This function builds a KD-tree over the end points of the lines
+    in lines_no_end.
+
+    Arguments:
+        lines_no_end {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no follow-up line.
+        active {NumPy array} -- An optional boolean mask of the lines in lines_no_end to add to the tree.
+        end_points {NumPy array} -- The optional end points of lines_no_end, from get_end_points().
+
+    Returns:
+        [Tuple] -- A tuple of the KD-tree, and the positions in lines_no_end of the points in the tree.
+    """
+    if end_points is None:
+        end_points = get_end_points(lines_no_end)
+    positions = np.arange(len(end_points)) if active is None else np.flatnonzero(active)
+    return cKDTree(end_points[positions]), positions
 
 
-def calculate_neighbors(lines_no_end, lines_no_begin):
+def calculate_neighbors(lines_no_end, lines_no_begin, end_point_tree=None, active=None, k=3, begin_points=None,
+                        workers=-1):
     """This function calculates the closest neighbors for each
     line in lines_no_end.
 
+    Only the e_x, e_y, b_x and b_y columns are read, the geometries are not used.
+
+    When an end_point_tree is given it is reused instead of building a new
+    one. Lines that are no longer active are skipped in the results, the
+    tree is queried for more neighbors until k active ones are found.
+
     Arguments:
         lines_no_end {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no follow-up line.
-        lines_no_begin {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no lead line.
+        lines_no_begin {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no lead line,
+        can be None when begin_points is given.
+        end_point_tree {Tuple} -- An optional tree returned by build_end_point_tree().
+        active {NumPy array} -- An optional boolean mask of the lines in lines_no_end that can be a neighbor.
+        k {int} -- The amount of neighbors to calculate.
+        begin_points {NumPy array} -- The optional begin points of lines_no_begin, from get_begin_points().
+        workers {int} -- The amount of threads used to query the tree, -1 uses all cores.
 
     Returns:
         [list] -- A list containing the indeces of the closest lines for each of the lines in lines_no_end.
     """
-    end_points = gpd.GeoSeries(lines_no_end.e_point.apply(wkt.loads))
-    begin_points = gpd.GeoSeries(lines_no_begin.b_point.apply(wkt.loads))
-
-    gd_a, gd_b = end_points, begin_points
+    if end_point_tree is None:
+        end_point_tree = build_end_point_tree(lines_no_end, active)
+    if active is None:
+        active = np.ones(len(lines_no_end), dtype=bool)
+    tree, positions = end_point_tree
+
+    n_b = get_begin_points(lines_no_begin) if begin_points is None else begin_points
+    k = min(k, np.count_nonzero(active[positions]))
+    indices = np.empty((len(n_b), k), dtype=np.intp)
+
+    # Query the rows that did not find k active neighbors again, with twice as many neighbors.
+    pending = np.arange(len(n_b))
+    k_query = k
+    while len(pending):
+        k_query = min(k_query, len(positions))
+        distances, neighbors = tree.query(n_b[pending], k=k_query, workers=workers)
+        neighbors = positions[np.reshape(neighbors, (len(pending), k_query))]
+        is_active = active[neighbors]
+
+        # Move the active neighbors to the front, keeping them ordered by distance.
+        order = np.argsort(~is_active, axis=1, kind='stable')
+        neighbors = np.take_along_axis(neighbors, order, axis=1)
+
+        done = np.count_nonzero(is_active, axis=1) >= k
+        indices[pending[done]] = neighbors[done, :k]
+        pending = pending[~done]
+        k_query *= 2
 
-    n_a = np.array(list(zip(gd_a.geometry.x, gd_a.geometry.y)))
-    n_b = np.array(list(zip(gd_b.geometry.x, gd_b.geometry.y)))
-    neighbors = NearestNeighbors(n_neighbors=3).fit(n_a)
-    distances, indices = neighbors.kneighbors(n_b)
     return indices
 
 
-def convert_to_id(column, df):
-    return column.apply(lambda x: df.index[x])
+def get_stale_lines(nearest, active_begin, active_end):
+    """Finds the active lines without begin that need a new nearest line.
 
+    The nearest line only changes when it got an artificial line itself,
+    or when it was not calculated yet.
 
-def generate_artificial_lines(lines_no_begin, lines_no_end):
-    """This function generates the data for artificial lines.
+    Arguments:
+        nearest {NumPy array} -- The position of the nearest line for every line without begin, -1 when unknown.
+        active_begin {NumPy array} -- A boolean mask of the active lines without begin.
+        active_end {NumPy array} -- A boolean mask of the active lines without end.
+
+    Returns:
+        [NumPy array] -- A boolean mask of the lines without begin that need a new nearest line.
+    """
+    valid = nearest >= 0
+    valid[valid] = active_end[nearest[valid]]
+    return active_begin & ~valid
+
+
+def get_dirty_lines(nearest, stale, active_begin, n_end):
+    """Finds the active lines without begin whose artificial line has to be compared again.
+
+    Only the lines without end that got a new neighbor can get a different
+    artificial line, so only the lines without begin next to those are dirty.
+    All other groups have the same members as before, and give the same result.
 
     Arguments:
-        lines_no_end {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no follow-up line.
-        lines_no_begin {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no lead line.
+        nearest {NumPy array} -- The position of the nearest line for every line without begin.
+        stale {NumPy array} -- A boolean mask of the lines without begin that got a new nearest line.
+        active_begin {NumPy array} -- A boolean mask of the active lines without begin.
+        n_end {int} -- The amount of lines without end.
 
     Returns:
-        [GeoPandas DataFrame] -- A GeoPandas DataFrame containing the data for the artificial lines.
+        [NumPy array] -- A boolean mask of the lines without begin to compare again.
     """
+    dirty_end = np.zeros(n_end, dtype=bool)
+    dirty_end[nearest[stale]] = True
+    dirty_begin = active_begin.copy()
+    dirty_begin[active_begin] = dirty_end[nearest[active_begin]]
+    return dirty_begin
 
-    begin_points = lines_no_begin['b_point']
-    end_points = lines_no_end.loc[lines_no_begin['first'], 'e_point']
 
-    artificial_lines = pd.DataFrame({'b_idx': list(begin_points.index),
-                                     'b_points': list(begin_points),
-                                     'e_idx': list(end_points.index),
-                                     'e_points': list(end_points)})
-    end_points = gpd.GeoSeries(artificial_lines.e_points.apply(wkt.loads))
-    begin_points = gpd.GeoSeries(artificial_lines.b_points.apply(wkt.loads))
+def convert_to_id(column, df):
+    """Converts positions in df to the ids of those lines.
 
-    artificial_lines['geometry'] = gpd.GeoSeries([LineString(x) for x in list(zip(end_points, begin_points))])
-    artificial_lines.drop(['b_points', 'e_points'], axis=1, inplace=True)
-    artificial_lines = gpd.GeoDataFrame(artificial_lines)
-    artificial_lines.set_index(['e_idx', 'b_idx'], inplace=True)
-    artificial_lines.sort_index(inplace=True)
-    return artificial_lines
+    Arguments:
+        column {NumPy array or Series} -- The positions of lines in df.
+        df {GeoPandas DataFrame} -- The GeoPandas DataFrame the positions refer to.
 
+    Returns:
+        [NumPy array or Series] -- The ids of the lines, as a Series with the index of column if
+        column is a Series.
+    """
+    ids = df.index.to_numpy()[np.asarray(column, dtype=np.intp)]
+    if isinstance(column, pd.Series):
+        return pd.Series(ids, index=column.index, name=column.name, copy=False)
+    return ids
 
-def calculate_cos(lines_no_begin, artificial_lines, lines_no_end, angle_treshold):
-    filtered_lines = []
 
-    for name, group in artificial_lines.groupby(level=0):
+def generate_artificial_lines(lines_no_begin, lines_no_end, first, begin_points=None, end_points=None,
+                              return_positions=False):
+    """This function generates the data for artificial lines.
 
-        min_degree = np.inf
-        min_degree_art = np.inf
-        max_idx = np.inf
+    Arguments:
+        lines_no_end {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no follow-up line.
+        lines_no_begin {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no lead line.
+        first {NumPy array} -- The position in lines_no_end of the nearest line for each line in lines_no_begin.
+        begin_points {NumPy array} -- The optional begin points of lines_no_begin, from get_begin_points().
+        end_points {NumPy array} -- The optional end points of lines_no_end, from get_end_points().
+        return_positions {bool} -- Also return the positions in lines_no_end and lines_no_begin of every
+        artificial line, the artificial lines are then sorted by position instead of by id.
 
-        for idx, line in enumerate(group.geometry.to_numpy(copy=True)):
+    Returns:
+        [GeoPandas DataFrame] -- A GeoPandas DataFrame containing the data for the artificial lines.
+        With return_positions the positions of both lines follow, as a tuple.
+    """
+    if begin_points is None:
+        begin_points = get_begin_points(lines_no_begin)
+    if end_points is None:
+        end_points = get_end_points(lines_no_end)
+
+    # Every artificial line runs from the end point to the begin point, as an (N, 2, 2) array.
+    coords = np.stack([end_points[first], begin_points], axis=1)
+    index = pd.MultiIndex.from_arrays([convert_to_id(first, lines_no_end), lines_no_begin.index],
+                                      names=['e_idx', 'b_idx'])
+
+    artificial_lines = gpd.GeoDataFrame(geometry=gpd.GeoSeries(shapely.linestrings(coords), index=index,
+                                                               crs=lines_no_end.crs))
+    if return_positions:
+        # Sorting by position keeps the groups contiguous, also when ids are duplicated.
+        end_positions = np.asarray(first, dtype=np.intp)
+        begin_positions = np.arange(len(end_positions))
+        order = np.lexsort((begin_positions, end_positions))
+        return artificial_lines.iloc[order], end_positions[order], begin_positions[order]
+    artificial_lines.sort_index(inplace=True)
+    return artificial_lines
 
-            line1 = lines_no_end.loc[group.iloc[idx, :].name[0], :].geometry.coords[-2:]
-            line2 = lines_no_begin.loc[group.iloc[idx, :].name[1], :].geometry.coords[:2]
-            art_line = list(line.coords)
 
-            angle1 = AngleBtw2Points(line1[0], line1[1])
-            angle2 = AngleBtw2Points(line2[0], line2[1])
-            art_angle = AngleBtw2Points(art_line[0], art_line[1])
+@njit(cache=True)
+def _segment_angle(p0, p1, i):
+    return math.atan2(p1[i, 1] - p0[i, 1], p1[i, 0] - p0[i, 0])
 
-            degree = abs(angle1 - angle2)
-            degree_art = abs(art_angle - angle2)
 
-            if degree < min_degree:
-                min_degree = degree
-                max_idx = idx
-                min_degree_art = degree_art
+@njit(parallel=True, fastmath=True, cache=True)
+def _min_angle_per_group(line1_p0, line1_p1, line2_p0, line2_p1, art_p0, art_p1,
+                         group_starts, group_ends, out_idx, out_angle, out_angle_art):
+    """Finds the artificial line with the smallest angle in every group.
 
-        row = {'e_idx': group.iloc[max_idx, :].name[0],
-               'b_idx': group.iloc[max_idx, :].name[1],
-               'angle': min_degree,
-               'angle_art': min_degree_art,
-               'geometry': group.iloc[max_idx, 0]}
+    Group g holds the pairs group_starts[g] up to group_ends[g]. The position
+    of the best pair and its angles are written to out_idx, out_angle and out_angle_art.
+    """
+    for g in prange(len(group_starts)):
+        start = group_starts[g]
+        angle2 = _segment_angle(line2_p0, line2_p1, start)
+        min_idx = start
+        min_angle = get_angle_difference(_segment_angle(line1_p0, line1_p1, start), angle2)
+        min_angle_art = get_angle_difference(_segment_angle(art_p0, art_p1, start), angle2)
+
+        for i in range(start + 1, group_ends[g]):
+            angle2 = _segment_angle(line2_p0, line2_p1, i)
+            angle = get_angle_difference(_segment_angle(line1_p0, line1_p1, i), angle2)
+            if angle < min_angle:
+                min_idx = i
+                min_angle = angle
+                min_angle_art = get_angle_difference(_segment_angle(art_p0, art_p1, i), angle2)
+
+        out_idx[g] = min_idx
+        out_angle[g] = min_angle
+        out_angle_art[g] = min_angle_art
+
+
+def calculate_cos(lines_no_begin, artificial_lines, lines_no_end, angle_treshold,
+                  end_segments=None, begin_segments=None, end_positions=None, begin_positions=None,
+                  return_positions=False):
+    """This function keeps the artificial line with the smallest angle for every
+    line without an end, if that angle is smaller than angle_treshold.
 
-        filtered_lines.append(row)
+    Arguments:
+        lines_no_begin {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no lead line.
+        artificial_lines {GeoPandas DataFrame} -- The artificial lines from generate_artificial_lines().
+        lines_no_end {GeoPandas DataFrame} -- A GeoPandas DataFrame containing the lines with no follow-up line.
+        angle_treshold {float} -- The largest acceptable angle in radians.
+        end_segments {NumPy array} -- The optional last segments of lines_no_end, from get_segments().
+        begin_segments {NumPy array} -- The optional first segments of lines_no_begin, from get_segments().
+        end_positions {NumPy array} -- The optional positions in lines_no_end of the artificial lines,
+        from generate_artificial_lines() with return_positions.
+        begin_positions {NumPy array} -- The optional positions in lines_no_begin of the artificial lines,
+        from generate_artificial_lines() with return_positions.
+        return_positions {bool} -- Also return the positions in lines_no_end and lines_no_begin of the
+        accepted artificial lines.
 
-    filtered_lines = gpd.GeoDataFrame(filtered_lines)
-    filtered_lines.set_index(['e_idx', 'b_idx'], inplace=True)
-    filtered_lines.sort_index(inplace=True)
-    same_begin_end = filtered_lines.index.get_level_values('e_idx') == filtered_lines.index.get_level_values('b_idx')
-    filtered_lines = filtered_lines[
-        (filtered_lines.angle < angle_treshold) & ~same_begin_end & (filtered_lines.angle_art < angle_treshold)]
+    Returns:
+        [GeoPandas DataFrame] -- A GeoPandas DataFrame containing the accepted artificial lines.
+        With return_positions the positions of both lines follow, as a tuple.
+    """
+    if end_positions is None or begin_positions is None:
+        # The groups of artificial lines have to be contiguous for the numba kernel.
+        if not artificial_lines.index.is_monotonic_increasing:
+            artificial_lines = artificial_lines.sort_index()
+        end_positions = lines_no_end.index.get_indexer(artificial_lines.index.get_level_values(0))
+        begin_positions = lines_no_begin.index.get_indexer(artificial_lines.index.get_level_values(1))
+
+    e_idx = artificial_lines.index.get_level_values(0)
+    b_idx = artificial_lines.index.get_level_values(1)
+
+    if end_segments is None:
+        end_segments = get_segments(lines_no_end.geometry.values)[1]
+    if begin_segments is None:
+        begin_segments = get_segments(lines_no_begin.geometry.values)[0]
+
+    # The last segment of the line without end, and the first segment of the line without begin.
+    line1 = end_segments[end_positions]
+    line2 = begin_segments[begin_positions]
+    line1_p0, line1_p1 = line1[:, 0], line1[:, 1]
+    line2_p0, line2_p1 = line2[:, 0], line2[:, 1]
+
+    # The artificial line runs from the end point of line1 to the begin point of line2.
+    art_p0, art_p1 = line1_p1, line2_p0
+    codes, uniques = pd.factorize(end_positions)
+
+    if NUMBA_AVAILABLE:
+        groups = np.arange(len(uniques))
+        group_starts = np.searchsorted(codes, groups, side='left')
+        group_ends = np.searchsorted(codes, groups, side='right')
+        best = np.empty(len(uniques), dtype=np.intp)
+        min_angle = np.empty(len(uniques))
+        min_angle_art = np.empty(len(uniques))
+        _min_angle_per_group(line1_p0, line1_p1, line2_p0, line2_p1, art_p0, art_p1,
+                             group_starts, group_ends, best, min_angle, min_angle_art)
+    else:
+        angle1 = get_angles(line1_p0, line1_p1)
+        angle2 = get_angles(line2_p0, line2_p1)
+        art_angle = get_angles(art_p0, art_p1)
+
+        angle = get_angle_difference(angle1, angle2)
+        angle_art = get_angle_difference(art_angle, angle2)
+
+        # Keep the artificial line with the smallest angle for every line without an end.
+        order = np.lexsort((angle, codes))
+        _, first = np.unique(codes[order], return_index=True)
+        best = order[first]
+        min_angle, min_angle_art = angle[best], angle_art[best]
+
+    same_begin_end = e_idx[best] == b_idx[best]
+    keep = (min_angle < angle_treshold) & ~same_begin_end & (min_angle_art < angle_treshold)
+    best = best[keep]
+
+    filtered_lines = gpd.GeoDataFrame({'angle': min_angle[keep],
+                                       'angle_art': min_angle_art[keep]},
+                                      geometry=artificial_lines.geometry.values[best],
+                                      index=artificial_lines.index[best])
+    _, order = filtered_lines.index.sortlevel()
+    filtered_lines = filtered_lines.iloc[order]
+    if return_positions:
+        return filtered_lines, end_positions[best][order], begin_positions[best][order]
     return filtered_lines
 
 
 def write_shapefile(df, path):
     df.crs = 'EPSG:4326'
-    df.to_file(path)
+    if IO_ENGINE == 'pyogrio':
+        pyogrio.write_dataframe(df, path, use_arrow=USE_ARROW)
+    else:
+        df.to_file(path, engine=IO_ENGINE)
 
 
 def prepare_df_for_concatenation(df, df2):
 
-    df['e_idx'] = df.index.get_level_values(0)
-    df['b_idx'] = df.index.get_level_values(1)
+    e_idx = df.index.get_level_values(0)
+    b_idx = df.index.get_level_values(1)
 
-    df['naam'] = "Artificial_" + df['e_idx'].astype(str) + "_" + df['b_idx'].astype(str)
+    # Arrow joins the names in one pass in C, without a Python call per line.
+    if ARROW_AVAILABLE:
+        names = pc.binary_join_element_wise("Artificial", pc.cast(pa.array(e_idx), pa.string()),
+                                            pc.cast(pa.array(b_idx), pa.string()), "_")
+        df['naam'] = names.to_numpy(zero_copy_only=False)
+    else:
+        df['naam'] = "Artificial_" + e_idx.astype(str) + "_" + b_idx.astype(str)
     df['dgl_loc'] = "_"
     df['ref_loc'] = "_"
     df['lengte'] = 0
@@ -183,62 +562,137 @@ def prepare_df_for_concatenation(df, df2):
     df['ref_begin'] = "_"
     df['ref_eind'] = "_"
 
-    # df.drop(columns=['e_idx', 'b_idx', 'angle', 'angle_art'], inplace=True)
     df = df[df2.columns]
 
     return df
 
 
+def parse_jobs(value):
+    """Parses the amount of threads given on the command line.
+
+    Arguments:
+        value {String} -- The value given for --j.
+
+    Returns:
+        [int] -- The amount of threads, -1 for all cores.
+
+    Raises:
+        argparse.ArgumentTypeError -- When the value is not -1 or a positive integer.
+    """
+    try:
+        jobs = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if jobs == 0 or jobs < -1:
+        raise argparse.ArgumentTypeError(f"must be -1 or a positive integer, got {jobs}")
+    return jobs
+
+
 def print_options(args):
     print(f"Running script with the following options:")
     print(f" - File path: {args.p},")
     print(f" - Acceptable angle: {args.d}")
     print(f" - Output path: {args.o}")
+    print(f" - Threads: {args.j}")
+
 
+def main(file_path, angle_threshold, output_path, n_jobs=-1):
 
-def main(file_path, angle_threshold, output_path):
+    # The neighbor search and the angle kernel use the same amount of threads.
+    if NUMBA_AVAILABLE and n_jobs > 0:
+        set_num_threads(min(n_jobs, config.NUMBA_NUM_THREADS))
+
+    # The angles are compared in radians.
+    angle_threshold = np.deg2rad(angle_threshold)
 
     # Read the shapefile into a GeoPandas DataFrame.
     df = read_shp(file_path)
     result_df = df.copy()
     result = gpd.GeoDataFrame(columns=df.columns)
 
+    # The coordinates of all lines are extracted once, and shared by all steps below.
+    line_ends = get_line_ends(df.geometry.values)
+
     # Identify lines that do not connect to another line at their begin or end point.
-    lines_no_end, lines_no_begin = get_lines(df)
+    lines_no_end, lines_no_begin, end_positions, begin_positions = get_lines(df, line_ends, return_positions=True)
 
     # Generate artificial lines
-    result_lines = gpd.GeoDataFrame()
+    collected_lines = []
+    result_length = 0
     previous_result_length = 0
 
-    # loop stops when iteration finds less than 5 new artificial lines.
+    # Every iteration only gathers the coordinates of the active lines.
+    end_points = line_ends[end_positions, 3]
+    begin_points = line_ends[begin_positions, 0]
+    end_segments = line_ends[end_positions, 2:]
+    begin_segments = line_ends[begin_positions, :2]
+
+    # Build the nearest neighbor tree once, lines that got an artificial line are masked out.
+    active_end = np.ones(len(lines_no_end), dtype=bool)
+    active_begin = np.ones(len(lines_no_begin), dtype=bool)
+    end_point_tree = build_end_point_tree(lines_no_end, end_points=end_points)
+
+    # The position of the nearest line for every line without begin, -1 when not calculated yet.
+    nearest = np.full(len(lines_no_begin), -1, dtype=np.intp)
+
+    # loop stops when iteration finds less than 5 new artificial lines, or when no line changed.
     while 1:
+        # The nearest line only changes when it got an artificial line itself.
+        stale = get_stale_lines(nearest, active_begin, active_end)
 
-        # Calculate and store the id of the nearest line.
-        lines_no_begin['first'] = calculate_neighbors(lines_no_end, lines_no_begin)[:, 0]
-        lines_no_begin['first'] = convert_to_id(lines_no_begin['first'], lines_no_end)
+        # Without new neighbors every line would get the same artificial line as before.
+        if not stale.any():
+            break
+
+        # All lines without end got an artificial line, there is no neighbor left.
+        if not active_end.any():
+            break
+
+        # Calculate the position of the nearest line.
+        nearest[stale] = calculate_neighbors(lines_no_end, None, end_point_tree, active_end, k=1,
+                                             begin_points=begin_points[stale], workers=n_jobs)[:, 0]
+
+        # Only the lines without begin next to a line without end that got a new neighbor are compared again.
+        dirty_begin = get_dirty_lines(nearest, stale, active_begin, len(lines_no_end))
+
+        current_lines_no_begin = lines_no_begin[dirty_begin]
+        first = nearest[dirty_begin]
 
         # Generates artificial lines between all lines without an end, with the nearest line.
-        artificial_lines = generate_artificial_lines(lines_no_begin, lines_no_end)
+        artificial_lines, art_end, art_begin = generate_artificial_lines(current_lines_no_begin, lines_no_end, first,
+                                                                         begin_points[dirty_begin], end_points,
+                                                                         return_positions=True)
 
         # filter out all artificial lines with a angle bigger than angle_threshold.
-        filtered_lines = calculate_cos(lines_no_begin, artificial_lines, lines_no_end, angle_threshold)
+        filtered_lines, filtered_end, filtered_begin = calculate_cos(current_lines_no_begin, artificial_lines,
+                                                                     lines_no_end, angle_threshold, end_segments,
+                                                                     begin_segments[dirty_begin], art_end, art_begin,
+                                                                     return_positions=True)
 
         # Add the artificial lines calculated in this loop to the total artificial lines.
-        result_lines = result_lines.append(filtered_lines)
+        collected_lines.append(filtered_lines)
+        result_length += len(filtered_lines)
 
         # Remove the lines that have got an artificial line assigned.
-        lines_no_begin.drop(filtered_lines.index.get_level_values(1), inplace=True)
-        lines_no_end.drop(filtered_lines.index.get_level_values(0), inplace=True)
+        active_begin[np.flatnonzero(dirty_begin)[filtered_begin]] = False
+        active_end[filtered_end] = False
+
+        # Rebuilding the tree is cheaper than skipping a large amount of removed points.
+        tree_positions = end_point_tree[1]
+        if np.count_nonzero(active_end[tree_positions]) < TREE_REBUILD_FRACTION * len(tree_positions):
+            end_point_tree = build_end_point_tree(lines_no_end, active_end, end_points)
 
         # If we can't find more than 5 new artificial lines, we stop searching.
-        if abs(previous_result_length - len(result_lines)) < 5:
+        if abs(previous_result_length - result_length) < 5:
             break
 
-        previous_result_length = len(result_lines)
+        previous_result_length = result_length
 
-    # Add artificial line to real line data.
-    result_lines = prepare_df_for_concatenation(result_lines, result_df)
-    result_df = result_df.append(result_lines, ignore_index=True)
+    # Add artificial line to real line data, the loop can stop before any artificial line is calculated.
+    if collected_lines:
+        result_lines = pd.concat(collected_lines, sort=False, copy=False)
+        result_lines = prepare_df_for_concatenation(result_lines, result_df)
+        result_df = pd.concat([result_df, result_lines], ignore_index=True, sort=False, copy=False)
 
     # write artificial lines to a new shapefile.
     write_shapefile(result_df, output_path)
@@ -270,13 +724,21 @@ if __name__ == "__main__":
                              "Default value = /filtered_lines.shp",
                         metavar='p')
 
+    parser.add_argument('--j', '--JOBS',
+                        type=parse_jobs,
+                        default=-1,
+                        help="The amount of threads used to search neighbors and compare angles, "
+                             "-1 uses all cores. \n"
+                             "Default value = -1",
+                        metavar='j')
+
     args = parser.parse_args()
 
     # Printing script options.
     print_options(args)
 
     start = timer()
-    main(args.p, args.d, args.o)
+    main(args.p, args.d, args.o, args.j)
     end = timer()
     print(f"Script finished.")
     print(f"Total time elapsed: {end - start} Seconds.")
@@ -1,7 +1,10 @@
+import argparse
 import pytest
 import main
 import numpy as np
-from shapely.geometry import MultiPoint, Point
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString, MultiLineString
 from hypothesis import given
 import hypothesis.strategies as st
 
@@ -9,88 +12,96 @@ import hypothesis.strategies as st
 df = main.read_shp('Meetvak/Meetvakken_WGS84.shp')
 lines_without_end, lines_without_begin = main.get_lines(df)
 indices = main.calculate_neighbors(lines_without_end, lines_without_begin)
-lines_without_begin['first'] = main.calculate_neighbors(lines_without_end, lines_without_begin)[:, 0]
-lines_without_begin_ids = main.convert_to_id(lines_without_begin['first'], lines_without_end).to_numpy(copy=True)
-lines_without_begin['first'] = main.convert_to_id(lines_without_begin['first'], lines_without_end)
-artificial_lines = main.generate_artificial_lines(lines_without_begin, lines_without_end)
+first = indices[:, 0]
+lines_without_begin_ids = main.convert_to_id(first, lines_without_end)
+artificial_lines = main.generate_artificial_lines(lines_without_begin, lines_without_end, first)
+filtered_lines = main.calculate_cos(lines_without_begin, artificial_lines, lines_without_end, np.deg2rad(7))
 
 
-# Function should return y coordinate
-def test_get_end_returns_second_coordinate_when_given_two_coordinates():
-    m = MultiPoint([(0, 0), (1, 1)])
-    assert (main.get_end(m) == "POINT (1 1)"), \
-        "The Coordinate returned by get_end() is not the the second coordinate."
-
-
-# Function should return x coordinate
-def test_get_begin_returns_first_coordinate_when_given_two_coordinates():
-    m = MultiPoint([(0, 0), (1, 1)])
-    assert (main.get_begin(m) == "POINT (0 0)"), \
-        "The coordinate returned by get_begin() is not equal to the first coordinate."
+def make_lines(*lines):
+    return gpd.GeoDataFrame({'geometry': [LineString(line) for line in lines]},
+                            index=pd.Index(range(len(lines)), name='id'))
 
 
 @given(st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=-1000000, max_value=1000000))
-def test_get_end_returns_second_coordinate_when_given_two_coordinates_random(x1, x2, y1, y2):
-    m = MultiPoint([(x1, x2), (y1, y2)])
-    assert (main.get_end(m) == f"POINT ({y1} {y2})"), \
-        "The Coordinate returned by get_end() is not the the second coordinate."
+# Function should store the first coordinate of a line as its begin point
+def test_get_lines_begin_point_is_first_coordinate_random(x1, x2, y1, y2):
+    lines = make_lines([(x1, x2), (x1 + 1, x2 + 1), (y1, y2)])
+    main.get_lines(lines)
+    assert (lines.b_x[0] == x1 and lines.b_y[0] == x2), \
+        "The begin point stored by get_lines() is not the first coordinate."
 
 
 @given(st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=-1000000, max_value=1000000))
-def test_get_begin_returns_first_coordinate_when_given_two_coordinates_random(x1, x2, y1, y2):
-    m = MultiPoint([(x1, x2), (y1, y2)])
-    assert (main.get_begin(m) == f"POINT ({x1} {x2})"), \
-        "The Coordinate returned by get_end() is not the the second coordinate."
+# Function should store the last coordinate of a line as its end point
+def test_get_lines_end_point_is_last_coordinate_random(x1, x2, y1, y2):
+    lines = make_lines([(x1, x2), (x1 + 1, x2 + 1), (y1, y2)])
+    main.get_lines(lines)
+    assert (lines.e_x[0] == y1 and lines.e_y[0] == y2), \
+        "The end point stored by get_lines() is not the last coordinate."
 
 
-# Function should not accept inputs with less than two coordinates
-def test_get_end_input_has_less_than_two_coordinates():
-    m = MultiPoint([(0, 0)])
-    with pytest.raises(Exception):
-        main.get_end(m)
+# Missing geometries should not silently take the coordinates of other lines.
+def test_get_line_ends_missing_geometry():
+    geometry = gpd.GeoSeries([LineString([(0, 0), (1, 1)]), None, LineString([(2, 2), (3, 3)])]).values
+    with pytest.raises(ValueError):
+        main.get_line_ends(geometry)
 
 
-@given(st.integers(min_value=-1000000, max_value=1000000),
-       st.integers(min_value=-1000000, max_value=1000000))
-# Function should not accept inputs with less than two coordinates
-def test_get_end_input_has_less_than_two_coordinates_random(x, y):
-    m = MultiPoint([(x, y)])
-    with pytest.raises(Exception):
-        main.get_end(m)
+# Only LineStrings are supported, other geometries should give a clear error.
+def test_get_line_ends_multilinestring():
+    geometry = gpd.GeoSeries([LineString([(0, 0), (1, 1)]),
+                              MultiLineString([[(2, 2), (3, 3)], [(4, 4), (5, 5)]])]).values
+    with pytest.raises(ValueError, match="LineString"):
+        main.get_line_ends(geometry)
+
+
+# A line whose end point is the begin point of another line has a follow-up line
+def test_get_lines_connected_lines():
+    lines = make_lines([(0, 0), (1, 1)], [(1, 1), (2, 2)])
+    lines_no_end, lines_no_begin = main.get_lines(lines)
+    assert (list(lines_no_end.index) == [1] and list(lines_no_begin.index) == [0]), \
+        "Connected lines are not detected by get_lines()."
 
 
 @given(st.integers(min_value=-1000000, max_value=1000000))
 # Function should return the angle between two identical points as 0.
-def test_AngleBtw2Points_same_points(x):
+def test_get_angles_same_points(x):
     point = [x, x]
-    assert main.AngleBtw2Points(point, point) == 0, \
-        "The AngleBtw2Points function does not return 0 for two identical points."
+    assert main.get_angles(point, point) == 0, \
+        "The get_angles function does not return 0 for two identical points."
 
 
 @given(st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=1, max_value=1000000))
 # Function should return the angle between two non identical points always bigger than 0
-def test_AngleBtw2Points_different_points_1(x, y):
+def test_get_angles_different_points_1(x, y):
     point_a = [x, x]
     point_b = [x+y, x+y]
-    assert main.AngleBtw2Points(point_a, point_b) > 0, \
-        "The AngleBtw2Points function does not return > 0 for two non identical points."
+    assert main.get_angles(point_a, point_b) > 0, \
+        "The get_angles function does not return > 0 for two non identical points."
 
 
 @given(st.integers(min_value=-1000000, max_value=1000000),
        st.integers(min_value=1, max_value=1000000))
 # Function should return the angle between two non identical points always smaller than 0
-def test_AngleBtw2Points_different_points_2(x, y):
+def test_get_angles_different_points_2(x, y):
     point_a = [x+y, x+y]
     point_b = [x, x]
-    assert main.AngleBtw2Points(point_a, point_b) < 0, \
-        "The AngleBtw2Points function does not return < 0 for two non identical points."
+    assert main.get_angles(point_a, point_b) < 0, \
+        "The get_angles function does not return < 0 for two non identical points."
+
+
+# Angles on both sides of the -pi/pi border should be close to each other.
+def test_get_angle_difference_wraps_around():
+    assert (np.isclose(main.get_angle_difference(np.pi - 0.01, -np.pi + 0.01), 0.02)), \
+        "get_angle_difference() does not wrap around at pi."
 
 
 # Function should set the id column as DataFrame
@@ -123,6 +134,50 @@ def test_calculate_neighbors_all_indices_in_range_of_len_lines_no_end():
         "Not all indices of neighbors can be found in lines without end."
 
 
+# All lines ending in the begin point of another line have a follow-up line
+def test_get_lines_shared_end_points():
+    lines = make_lines([(0, 0), (1, 1)], [(0, 2), (1, 1)], [(1, 1), (2, 2)], [(5, 5), (6, 6)])
+    lines_no_end, lines_no_begin = main.get_lines(lines)
+    assert (list(lines_no_end.index) == [2, 3] and list(lines_no_begin.index) == [0, 1, 3]), \
+        "Lines sharing an end point are not all connected by get_lines()."
+
+
+# The positions returned by get_lines should point to the same lines in df
+def test_get_lines_returns_positions():
+    lines = make_lines([(0, 0), (1, 1)], [(1, 1), (2, 2)], [(5, 5), (6, 6)])
+    lines_no_end, lines_no_begin, end_positions, begin_positions = main.get_lines(lines, return_positions=True)
+    assert (list(end_positions) == [1, 2] and list(begin_positions) == [0, 2]), \
+        "The positions returned by get_lines() do not match the lines."
+
+
+# End points that differ less than the rounding precision should still connect.
+def test_get_lines_connects_points_within_precision():
+    lines = make_lines([(0, 0), (1, 1)], [(1 + 1e-10, 1), (2, 2)])
+    lines_no_end, lines_no_begin = main.get_lines(lines)
+    assert (list(lines_no_end.index) == [1] and list(lines_no_begin.index) == [0]), \
+        "Points within the rounding precision are not connected by get_lines()."
+
+
+# The neighbors should be calculated from the point columns alone, without geometries.
+def test_calculate_neighbors_uses_point_columns():
+    lines_no_end = pd.DataFrame({'e_x': [0., 5., 10.], 'e_y': [0., 0., 0.]})
+    lines_no_begin = pd.DataFrame({'b_x': [9., 4.], 'b_y': [1., 1.]})
+    neighbors = main.calculate_neighbors(lines_no_end, lines_no_begin, k=1)
+    assert (list(neighbors[:, 0]) == [2, 1]), \
+        "calculate_neighbors() does not use the point columns."
+
+
+# Lines that are not active should never be returned as a neighbor.
+def test_calculate_neighbors_skips_inactive_lines():
+    lines = make_lines([(0, 0), (1, 0)], [(0, 10), (1, 10)], [(1.5, 0), (3, 0)])
+    lines_no_end, lines_no_begin = main.get_lines(lines)
+    end_point_tree = main.build_end_point_tree(lines_no_end)
+    active = np.array([False, True, True])
+    neighbors = main.calculate_neighbors(lines_no_end, lines_no_begin.loc[[2]], end_point_tree, active, k=1)
+    assert (neighbors[0, 0] == 2), \
+        "calculate_neighbors() returned a line that is not active."
+
+
 # The amount of artificial lines should be equal to the amount of lines without begin.
 def test_generate_artificial_lines_length_of_artificial_lines_is_equal_to_length_lines_no_begin():
     assert (len(artificial_lines) == len(lines_without_begin)), \
@@ -160,3 +215,199 @@ def test_convert_to_id():
                                                   lines_without_begin_ids)
     assert (np.all(id_in_lines_without_end)), \
         "Not all id's can be found int lines without ends."
+
+
+# Every line without an end should get at most one artificial line.
+def test_calculate_cos_one_artificial_line_per_line_without_end():
+    assert (filtered_lines.index.get_level_values(0).is_unique), \
+        "Some lines without end have more than one artificial line."
+
+
+# All artificial lines kept by calculate_cos should be within the angle threshold.
+def test_calculate_cos_angles_below_threshold():
+    assert (np.all(filtered_lines.angle < np.deg2rad(7)) and np.all(filtered_lines.angle_art < np.deg2rad(7))), \
+        "Not all artificial lines are within the angle threshold."
+
+
+# The kernel should pick the pair with the smallest angle within each group.
+def test_min_angle_per_group_picks_smallest_angle():
+    line1_p0 = np.array([[0., 0.], [0., 0.], [0., 0.]])
+    line1_p1 = np.array([[1., 0.], [1., 0.], [1., 0.]])
+    line2_p0 = np.array([[2., 0.], [2., 0.], [2., 0.]])
+    line2_p1 = np.array([[2., 1.], [3., 0.], [3., 1.]])
+    best, angle, angle_art = np.empty(2, dtype=np.intp), np.empty(2), np.empty(2)
+    main._min_angle_per_group(line1_p0, line1_p1, line2_p0, line2_p1, line1_p1, line2_p0,
+                              np.array([0, 2]), np.array([2, 3]), best, angle, angle_art)
+    assert (list(best) == [1, 2] and angle[0] == 0 and np.isclose(angle[1], np.pi / 4)), \
+        "The kernel did not pick the artificial line with the smallest angle."
+
+
+# A Series of positions should be converted to a Series of ids with the same index.
+def test_convert_to_id_keeps_series_index():
+    column = pd.Series(first, index=lines_without_begin.index)
+    ids = main.convert_to_id(column, lines_without_end)
+    assert (ids.index.equals(column.index) and np.array_equal(ids.to_numpy(), lines_without_begin_ids.ravel())), \
+        "convert_to_id() does not keep the index of the Series."
+
+
+# The artificial lines should get the columns of the original lines, and a name built from both ids.
+def test_prepare_df_for_concatenation_names_and_columns():
+    original = df.drop(columns=['b_x', 'b_y', 'e_x', 'e_y'])
+    prepared = main.prepare_df_for_concatenation(filtered_lines.copy(), original)
+    e_idx, b_idx = filtered_lines.index[0]
+    assert (list(prepared.columns) == list(original.columns) and
+            prepared.naam.iloc[0] == f"Artificial_{e_idx}_{b_idx}"), \
+        "prepare_df_for_concatenation() does not build the expected columns."
+
+
+# prepare_df_for_concatenation should build the same names with and without pyarrow.
+def test_prepare_df_for_concatenation_arrow_and_pandas_names_agree(monkeypatch):
+    original = df.copy()
+    with_arrow = main.prepare_df_for_concatenation(filtered_lines.copy(), original)
+    monkeypatch.setattr(main, 'ARROW_AVAILABLE', False)
+    without_arrow = main.prepare_df_for_concatenation(filtered_lines.copy(), original)
+    assert (list(with_arrow.naam) == list(without_arrow.naam)), \
+        "prepare_df_for_concatenation() builds different names without pyarrow."
+
+
+# calculate_cos should give the same result with and without numba.
+def test_calculate_cos_numba_and_numpy_paths_agree(monkeypatch):
+    monkeypatch.setattr(main, 'NUMBA_AVAILABLE', True)
+    with_numba = main.calculate_cos(lines_without_begin, artificial_lines, lines_without_end, np.deg2rad(7))
+    monkeypatch.setattr(main, 'NUMBA_AVAILABLE', False)
+    without_numba = main.calculate_cos(lines_without_begin, artificial_lines, lines_without_end, np.deg2rad(7))
+    assert (with_numba.index.equals(without_numba.index) and
+            np.allclose(with_numba.angle, without_numba.angle) and
+            np.allclose(with_numba.angle_art, without_numba.angle_art)), \
+        "calculate_cos() gives a different result without numba."
+
+
+# With positions calculate_cos should keep the same lines, and return the positions of those lines.
+def test_calculate_cos_returns_positions():
+    artificial, art_end, art_begin = main.generate_artificial_lines(lines_without_begin, lines_without_end, first,
+                                                                    return_positions=True)
+    filtered, end_positions, begin_positions = main.calculate_cos(lines_without_begin, artificial, lines_without_end,
+                                                                  np.deg2rad(7), end_positions=art_end,
+                                                                  begin_positions=art_begin, return_positions=True)
+    assert (filtered.index.equals(filtered_lines.index) and
+            (lines_without_end.index[end_positions] == filtered.index.get_level_values(0)).all() and
+            (lines_without_begin.index[begin_positions] == filtered.index.get_level_values(1)).all()), \
+        "The positions returned by calculate_cos() do not match the accepted lines."
+
+
+@given(st.integers(min_value=1, max_value=1024))
+# The amount of threads should accept -1 and positive integers.
+def test_parse_jobs_accepts_positive_values(jobs):
+    assert (main.parse_jobs(str(jobs)) == jobs and main.parse_jobs("-1") == -1), \
+        "parse_jobs() does not accept a valid amount of threads."
+
+
+@given(st.integers(min_value=-1000, max_value=0).filter(lambda x: x != -1))
+# The amount of threads should reject 0 and values below -1.
+def test_parse_jobs_rejects_invalid_values(jobs):
+    with pytest.raises(argparse.ArgumentTypeError):
+        main.parse_jobs(str(jobs))
+
+
+# Lines without a nearest line, or whose nearest line got an artificial line, need a new one.
+def test_get_stale_lines():
+    nearest = np.array([-1, 0, 1, 2])
+    active_begin = np.array([True, True, True, False])
+    active_end = np.array([True, False, True])
+    stale = main.get_stale_lines(nearest, active_begin, active_end)
+    assert (list(stale) == [True, True, False, False]), \
+        "get_stale_lines() does not find the lines that need a new nearest line."
+
+
+# All active lines next to a line without end that got a new neighbor have to be compared again.
+def test_get_dirty_lines():
+    nearest = np.array([2, 0, 1, 0])
+    stale = np.array([True, False, False, False])
+    active_begin = np.array([True, True, True, False])
+    dirty = main.get_dirty_lines(nearest, stale, active_begin, 3)
+    assert (list(dirty) == [True, False, False, False]), \
+        "get_dirty_lines() does not find the lines to compare again."
+
+
+def make_road_frame(lines):
+    columns = {column: "_" for column in ['dgl_loc', 'ref_loc', 'wegtype', 'meetgeg', 'ref_begin', 'ref_eind']}
+    return gpd.GeoDataFrame({'naam': [f"road_{i}" for i in range(len(lines))], 'lengte': 1., **columns},
+                            geometry=[LineString(line) for line in lines],
+                            index=pd.Index(range(len(lines)), name='id'), crs='EPSG:4326')
+
+
+def run_main(monkeypatch, roads):
+    written = {}
+    monkeypatch.setattr(main, 'read_shp', lambda path: roads.copy())
+    monkeypatch.setattr(main, 'write_shapefile', lambda df, path: written.update(df=df))
+    main.main('roads.shp', 7, 'roads_output.shp')
+    return written['df']
+
+
+def make_road_network(roads=10):
+    # Every road has a line B1 that follows E1 directly. Line B2 is also nearest to E1,
+    # loses it to B1, and only finds its lead line E2 in the second iteration.
+    direction = np.array([10., .5]) / np.hypot(10., .5)
+    lines = []
+    for road in range(roads):
+        y = 100. * road
+        b2_begin = np.array([1.5, y + .05])
+        e2_end = b2_begin - 1.6 * direction
+        e2_middle = e2_end - 10 * direction
+        lines += [[(-10., y), (0., y)],
+                  [(1., y), (11., y)],
+                  [tuple(b2_begin), tuple(b2_begin + 10 * direction)],
+                  [tuple(e2_middle - (0., 10.)), tuple(e2_middle), tuple(e2_end)]]
+    return make_road_frame(lines)
+
+
+def full_recompute(df, angle_threshold):
+    # The loop of main() without any incremental state, every iteration starts from scratch.
+    lines_no_end, lines_no_begin = main.get_lines(df)
+    collected_lines = []
+    previous_result_length = 0
+    result_length = 0
+    while 1:
+        first = main.calculate_neighbors(lines_no_end, lines_no_begin)[:, 0]
+        artificial = main.generate_artificial_lines(lines_no_begin, lines_no_end, first)
+        filtered = main.calculate_cos(lines_no_begin, artificial, lines_no_end, angle_threshold)
+        collected_lines.append(filtered)
+        result_length += len(filtered)
+        lines_no_begin = lines_no_begin.drop(filtered.index.get_level_values(1))
+        lines_no_end = lines_no_end.drop(filtered.index.get_level_values(0))
+        if abs(previous_result_length - result_length) < 5:
+            break
+        previous_result_length = result_length
+    return pd.concat(collected_lines)
+
+
+# The incremental loop in main() should find the same artificial lines as recomputing everything.
+def test_main_incremental_loop_matches_full_recompute(monkeypatch):
+    roads = make_road_network()
+    names = run_main(monkeypatch, roads).naam
+    incremental = set(names[names.str.startswith("Artificial_")])
+    full = {f"Artificial_{e_idx}_{b_idx}" for e_idx, b_idx in full_recompute(roads.copy(), np.deg2rad(7)).index}
+    assert (incremental == full and len(full) == 20), \
+        "The incremental loop in main() does not find the same artificial lines as a full recompute."
+
+
+# main() should stop when every line without end got an artificial line, while lines without begin remain.
+def test_main_stops_when_all_lines_without_end_are_used(monkeypatch):
+    # B1 and B2 both end at the begin of E1, and only B1 can follow E1.
+    lines = []
+    for road in range(5):
+        y = 100. * road
+        lines += [[(-10., y), (0., y)],
+                  [(1., y), (11., y), (-10., y)],
+                  [(1., y + .05), (11., y + .55), (-10., y)]]
+    result = run_main(monkeypatch, make_road_frame(lines))
+    assert (len(result) == 20 and result.naam.str.startswith("Artificial_").sum() == 5), \
+        "main() does not stop when all lines without end got an artificial line."
+
+
+# main() should write the lines unchanged when no line is without begin.
+def test_main_without_lines_without_begin(monkeypatch):
+    roads = make_road_frame([[(0., 0.), (1., 0.)], [(1., 0.), (0., 0.)], [(0., 0.), (5., 5.)]])
+    result = run_main(monkeypatch, roads)
+    assert (list(result.naam) == list(roads.naam)), \
+        "main() does not write the lines unchanged when no line is without begin."